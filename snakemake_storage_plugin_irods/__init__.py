@@ -1,21 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-import datetime
+from functools import cached_property, lru_cache
 import json
 import os
+import re
+import threading
 from pathlib import PosixPath
-from typing import Any, Iterable, Optional, List
-from urllib.parse import urlparse
+from types import MappingProxyType
+from typing import Any, Iterable, Mapping, Optional, List
+from urllib.parse import ParseResult, urlparse
 
 from irods.session import iRODSSession
-from irods.models import DataObject
+from irods.models import Collection, DataObject, DataObjectMeta
 from irods.exception import (
     CollectionDoesNotExist,
     DataObjectDoesNotExist,
     CAT_NO_ACCESS_PERMISSION,
     CAT_NAME_EXISTS_AS_DATAOBJ,
+    CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME,
 )
+from irods.column import Like
 import irods.keywords as kw
+from irods.password_obfuscation import decode
 
+from snakemake_interface_common.exceptions import WorkflowError
 from snakemake_interface_storage_plugins.settings import StorageProviderSettingsBase
 from snakemake_interface_storage_plugins.storage_provider import (  # noqa: F401
     StorageProviderBase,
@@ -30,11 +38,37 @@ from snakemake_interface_storage_plugins.storage_object import (
     StorageObjectGlob,
     retry_decorator,
 )
-from snakemake_interface_storage_plugins.io import IOCacheStorageInterface
+from snakemake_interface_storage_plugins.io import (
+    IOCacheStorageInterface,
+    Mtime,
+    get_constant_prefix,
+)
+
 
+# like urlparse, accept the scheme in any case
+_IRODS_QUERY_RE = re.compile(r"^irods://[^/?#]*/[^?#]", re.IGNORECASE)
 
 env_msg = "Will also be read from ~/.irods/irods_environment.json if present."
 
+# Mapping of keys in irods_environment.json to the corresponding settings.
+_ENV_MAPPING: tuple[tuple[str, str], ...] = (
+    ("irods_host", "host"),
+    ("irods_port", "port"),
+    ("irods_user_name", "username"),
+    ("irods_password", "password"),
+    ("irods_zone_name", "zone"),
+    ("irods_authentication_scheme", "authentication_scheme"),
+    ("irods_home", "home"),
+)
+
+
+@lru_cache(maxsize=4)
+def _load_irods_env(path: str, mtime_ns: int) -> Mapping[str, Any]:
+    # The modification time is part of the cache key, such that edits of the
+    # environment file are picked up without having to restart.
+    with open(path) as f:
+        return MappingProxyType(json.load(f))
+
 
 @dataclass
 class StorageProviderSettings(StorageProviderSettingsBase):
@@ -65,9 +99,10 @@ class StorageProviderSettings(StorageProviderSettingsBase):
     password: Optional[str] = field(
         default=None,
         metadata={
-            "help": f"The password for the iRODS server. {env_msg}",
+            "help": f"The password for the iRODS server. {env_msg} "
+            "Otherwise, the password stored in ~/.irods/.irodsA by iinit is used.",
             "env_var": True,
-            "required": True,
+            "required": False,
         },
     )
     zone: Optional[str] = field(
@@ -94,27 +129,95 @@ class StorageProviderSettings(StorageProviderSettingsBase):
             "required": True,
         },
     )
+    parallel_transfers: int = field(
+        default=4,
+        metadata={
+            "help": "The number of files that are transferred concurrently when "
+            "retrieving or storing a directory.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    keepalive_interval: float = field(
+        default=30.0,
+        metadata={
+            "help": "The interval in seconds at which a cheap request is sent to the "
+            "iRODS server, such that idle connections are not dropped and need no new "
+            "handshake. Must be at least 1, set to 0 to disable.",
+            "env_var": False,
+            "required": False,
+        },
+    )
+    parallel_transfer_threads: int = field(
+        default=0,
+        metadata={
+            "help": "The number of threads used for transferring a single large "
+            "file. By default (0), python-irodsclient chooses it automatically.",
+            "env_var": False,
+            "required": False,
+        },
+    )
 
     def __post_init__(self):
-        env_file = PosixPath(os.path.expanduser("~/.irods/irods_environment.json"))
-        if env_file.exists():
-            with open(env_file) as f:
-                env = json.load(f)
-
-            def retrieve(src, trgt):
-                if getattr(self, trgt) is None:
-                    setattr(self, trgt, env[src])
-
-            retrieve("irods_host", "host")
-            retrieve("irods_port", "port")
-            retrieve("irods_user_name", "username")
-            retrieve("irods_password", "password")
-            retrieve("irods_zone_name", "zone")
-            retrieve("irods_authentication_scheme", "authentication_scheme")
-            retrieve("irods_home", "home")
+        if self.parallel_transfers < 1:
+            raise WorkflowError(
+                "The number of parallel transfers of the iRODS storage plugin "
+                "(--storage-irods-parallel-transfers) must be at least 1, got "
+                f"{self.parallel_transfers}."
+            )
+        if self.keepalive_interval != 0 and self.keepalive_interval < 1:
+            raise WorkflowError(
+                "The keepalive interval of the iRODS storage plugin "
+                "(--storage-irods-keepalive-interval) must be at least 1 second, or 0 "
+                f"to disable it, got {self.keepalive_interval}."
+            )
+        env_file = os.path.expanduser("~/.irods/irods_environment.json")
+        try:
+            mtime_ns = os.stat(env_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        env = _load_irods_env(env_file, mtime_ns)
+        for src, trgt in _ENV_MAPPING:
+            value = env.get(src)
+            if value is not None and getattr(self, trgt) is None:
+                setattr(self, trgt, value)
+
+
+@lru_cache(maxsize=4)
+def _load_irodsA(path: str, mtime_ns: int) -> str:
+    with open(path) as f:
+        return decode(f.read().rstrip("\n"))
+
+
+# Sessions are shared between providers with identical connection parameters,
+# such that authentication only has to happen once per process.
+_SESSION_POOL: dict[tuple, iRODSSession] = {}
+# number of providers currently using each pooled session
+_SESSION_USERS: dict[tuple, int] = {}
+_SESSION_POOL_LOCK = threading.Lock()
+
+
+def _keep_alive(key: tuple, session: iRODSSession, collection: str, interval: float):
+    with _SESSION_POOL_LOCK:
+        if _SESSION_POOL.get(key) is not session:
+            # session has been removed via StorageProvider.close()
+            return
+    try:
+        session.collections.get(collection)
+    except Exception:
+        # Any failure (e.g. no access to the zone collection) must not stop the
+        # keepalive. Actual problems will surface with the next real request.
+        pass
+    _schedule_keep_alive(key, session, collection, interval)
 
 
-utc = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+def _schedule_keep_alive(
+    key: tuple, session: iRODSSession, collection: str, interval: float
+):
+    # Periodically send a cheap request as long as the session is in the pool.
+    timer = threading.Timer(interval, _keep_alive, (key, session, collection, interval))
+    timer.daemon = True
+    timer.start()
 
 
 # Required:
@@ -131,14 +234,72 @@ class StorageProvider(StorageProviderBase):
         # This is optional and can be removed if not needed.
         # Alternatively, you can e.g. prepare a connection to your storage backend here.
         # and set additional attributes.
-        self.session = iRODSSession(
+        password = self.settings.password
+        if password is None:
+            # fall back to the password stored by iinit
+            irods_a = os.path.expanduser("~/.irods/.irodsA")
+            try:
+                password = _load_irodsA(irods_a, os.stat(irods_a).st_mtime_ns)
+            except FileNotFoundError:
+                # All other required settings have already been checked by Snakemake,
+                # but the password is optional there because of this fallback.
+                raise WorkflowError(
+                    "No password given for the iRODS storage plugin. Specify it via "
+                    "--storage-irods-password, in ~/.irods/irods_environment.json or "
+                    "by running iinit."
+                )
+        self._session_kwargs = dict(
             host=self.settings.host,
             port=self.settings.port,
             user=self.settings.username,
-            password=self.settings.password,
+            password=password,
             zone=self.settings.zone,
             authentication_scheme=self.settings.authentication_scheme,
         )
+        self._session_key = tuple(self._session_kwargs.values())
+        # collections that have already been inventoried via StorageObject.inventory
+        self._inventoried_parents: set[str] = set()
+        # the cache that was last passed to StorageObject.inventory
+        self._iocache: Optional[IOCacheStorageInterface] = None
+        # collections that are known to exist, such that store_object can skip them
+        self._known_collections: set[str] = set()
+        # results of StorageObject.list_candidate_matches, keyed by constant prefix
+        self._candidate_matches: dict[str, List[str]] = {}
+
+    @cached_property
+    def session(self) -> iRODSSession:
+        # The session is only obtained on first use, such that no connection is
+        # established if the workflow does not access iRODS at all.
+        with _SESSION_POOL_LOCK:
+            session = _SESSION_POOL.get(self._session_key)
+            if session is None:
+                session = iRODSSession(**self._session_kwargs)
+                _SESSION_POOL[self._session_key] = session
+                interval = self.settings.keepalive_interval
+                if interval > 0:
+                    _schedule_keep_alive(
+                        self._session_key, session, f"/{self.settings.zone}", interval
+                    )
+            _SESSION_USERS[self._session_key] = (
+                _SESSION_USERS.get(self._session_key, 0) + 1
+            )
+        return session
+
+    def close(self):
+        """Release the session of this provider. Once no other provider uses it
+        anymore, it is removed from the pool and its connections are closed."""
+        if "session" not in self.__dict__:
+            # session has never been used
+            return
+        session = self.session
+        del self.session
+        with _SESSION_POOL_LOCK:
+            _SESSION_USERS[self._session_key] -= 1
+            if _SESSION_USERS[self._session_key] > 0:
+                return
+            del _SESSION_USERS[self._session_key]
+            del _SESSION_POOL[self._session_key]
+        session.cleanup()
 
     @classmethod
     def example_queries(cls) -> List[ExampleQuery]:
@@ -158,12 +319,16 @@ class StorageProvider(StorageProviderBase):
         E.g. for a storage provider like http that would be the host name.
         For s3 it might be just the endpoint URL.
         """
-        return self.settings.host
+        # Separate limiters per operation, such that e.g. transfers do not throttle
+        # existence checks.
+        return self.settings.host, operation
 
     def default_max_requests_per_second(self) -> float:
         """Return the default maximum number of requests per second for this storage
         provider."""
-        return 10.0
+        # Metadata of whole collections is fetched in bulk via inventory(), hence
+        # individual requests are rare and do not need to be throttled as strongly.
+        return 50.0
 
     def use_rate_limiter(self) -> bool:
         """Return False if no rate limiting is needed for this provider."""
@@ -175,8 +340,7 @@ class StorageProvider(StorageProviderBase):
         # Ensure that also queries containing wildcards (e.g. {sample}) are accepted
         # and considered valid. The wildcards will be resolved before the storage
         # object is actually used.
-        parsed = urlparse(query)
-        if parsed.scheme == "irods" and parsed.path:
+        if _IRODS_QUERY_RE.match(query):
             return StorageQueryValidationResult(valid=True, query=query)
         else:
             return StorageQueryValidationResult(
@@ -187,6 +351,18 @@ class StorageProvider(StorageProviderBase):
             )
 
 
+def _irods_path(query: str) -> str:
+    # e.g. irods://zone/folder/sample_ -> /zone/folder/sample_
+    # (the scheme may be in any case, see _IRODS_QUERY_RE)
+    return "/" + query[len("irods://") :]
+
+
+@lru_cache(maxsize=4096)
+def _parse_query(query: str) -> tuple[ParseResult, PosixPath]:
+    parsed = urlparse(query)
+    return parsed, PosixPath(f"/{parsed.netloc}") / parsed.path.lstrip("/")
+
+
 # Required:
 # Implementation of storage object. If certain methods cannot be supported by your
 # storage (e.g. because it is read-only see
@@ -201,32 +377,55 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
         # This is optional and can be removed if not needed.
         # Alternatively, you can e.g. prepare a connection to your storage backend here.
         # and set additional attributes.
-        self.parsed_query = urlparse(self.query)
-        self.path = PosixPath(
-            f"/{self.parsed_query.netloc}"
-        ) / self.parsed_query.path.lstrip("/")
+        self.parsed_query, self.path = _parse_query(self.query)
+        self._path_str = str(self.path)
+        self._cached_obj = None
 
     async def inventory(self, cache: IOCacheStorageInterface):
         """From this file, try to find as much existence and modification date
         information as possible. Only retrieve that information that comes for free
         given the current object.
         """
-        # This is optional and can be left as is
-
-        # If this is implemented in a storage object, results have to be stored in
-        # the given IOCache object, using self.cache_key() as key.
-        # Optionally, this can take a custom local suffix, needed e.g. when you want
-        # to cache more items than the current query: self.cache_key(local_suffix=...)
-        pass
+        if self._overwrite_local_path is not None:
+            # no cache key applicable
+            return
+        if self.provider._iocache is not cache:
+            # a new cache does not contain the previously inventoried collections
+            self.provider._iocache = cache
+            self.provider._inventoried_parents.clear()
+        parent = self.get_inventory_parent()
+        if parent in self.provider._inventoried_parents:
+            # collection has been inventoried before, stop here
+            return
+        self.provider._inventoried_parents.add(parent)
+
+        session = self.provider.session
+        # mtime AVUs take precedence over the modification time of the data object,
+        # see mtime()
+        mtimes = {
+            row[DataObject.name]: float(row[DataObjectMeta.value])
+            for row in session.query(DataObject.name, DataObjectMeta.value).filter(
+                Collection.name == parent, DataObjectMeta.name == "mtime"
+            )
+        }
+        for row in session.query(
+            DataObject.name, DataObject.size, DataObject.modify_time
+        ).filter(Collection.name == parent):
+            name = row[DataObject.name]
+            key = self.cache_key(local_suffix=f"{parent}/{name}".lstrip("/"))
+            cache.exists_in_storage[key] = True
+            cache.mtime[key] = Mtime(
+                storage=mtimes.get(name, row[DataObject.modify_time].timestamp())
+            )
+            cache.size[key] = row[DataObject.size]
 
     def get_inventory_parent(self) -> Optional[str]:
         """Return the parent directory of this object."""
-        # this is optional and can be left as is
-        return None
+        return str(self.path.parent)
 
     def local_suffix(self) -> str:
         """Return a unique suffix for the local path, determined from self.query."""
-        return str(self.path).lstrip("/")
+        return self._path_str.lstrip("/")
 
     def cleanup(self):
         """Perform local cleanup of any remainders of the storage object."""
@@ -241,49 +440,145 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
     def exists(self) -> bool:
         # TODO does this also work for collections?
         # return True if the object exists
+        cache = self._iocache()
+        if cache is not None and cache.exists_in_storage.get(self.cache_key()):
+            return True
         try:
             self._data_obj()
             return True
         except (CollectionDoesNotExist, DataObjectDoesNotExist):
             return False
 
+    def _iocache(self) -> Optional[IOCacheStorageInterface]:
+        # Objects with an overwritten local path (e.g. for uploading sources or
+        # for the between workflow cache) have no cache key.
+        if self._overwrite_local_path is not None:
+            return None
+        return self.provider._iocache
+
+    def _invalidate(self):
+        # Drop all information on this object that has been cached before it was
+        # modified.
+        self._cached_obj = None
+        # candidate matches that may contain this object (or its contents, if it
+        # is a directory)
+        dir_prefix = f"{self._path_str}/"
+        self.provider._candidate_matches = {
+            prefix: matches
+            for prefix, matches in self.provider._candidate_matches.items()
+            if not self._path_str.startswith(_irods_path(prefix))
+            and not _irods_path(prefix).startswith(dir_prefix)
+        }
+        cache = self._iocache()
+        if cache is not None:
+            key = self.cache_key()
+            cache.exists_in_storage.pop(key, None)
+            cache.mtime.pop(key, None)
+            cache.size.pop(key, None)
+
     def _data_obj(self):
-        return self.provider.session.data_objects.get(str(self.path))
+        # The data object is fetched once and reused by exists(), mtime() and size()
+        # as long as Snakemake's IOCache is active. Once it is deactivated, Snakemake
+        # expects up to date information, e.g. on outputs stored by other jobs.
+        # It is also invalidated whenever the object is modified via store_object()
+        # or remove(), see _invalidate().
+        if not getattr(self.provider._iocache, "active", False):
+            self._cached_obj = None
+            return self.provider.session.data_objects.get(self._path_str)
+        if self._cached_obj is None:
+            self._cached_obj = self.provider.session.data_objects.get(self._path_str)
+        return self._cached_obj
 
     @retry_decorator
     def mtime(self) -> float:
         # TODO does this also work for collections (i.e. directories)?
         # return the modification time
-        meta = self.provider.session.metadata.get(DataObject, str(self.path))
-        for m in meta:
+        cache = self._iocache()
+        if cache is not None:
+            mtime = cache.mtime.get(self.cache_key())
+            if mtime is not None and mtime.storage() is not None:
+                return mtime.storage()
+        obj = self._data_obj()
+        for m in obj.metadata.items():
             if m.name == "mtime":
                 return float(m.value)
-        # TODO is this conversion needed? Unix timestamp is always UTC, right?
-        # dt = self._convert_time(self._data_obj().modify_time, timezone)
-        return self._data_obj().modify_time.timestamp()
+        # python-irodsclient returns timezone-aware UTC datetimes
+        return obj.modify_time.timestamp()
 
     @retry_decorator
     def size(self) -> int:
         # return the size in bytes
+        cache = self._iocache()
+        if cache is not None:
+            size = cache.size.get(self.cache_key())
+            if size is not None:
+                return size
         return self._data_obj().size
 
     @retry_decorator
     def retrieve_object(self):
         # Ensure that the object is accessible locally under self.local_path()
         opts = {kw.FORCE_FLAG_KW: ""}
+        num_threads = self.provider.settings.parallel_transfer_threads
         try:
             # is directory
-            collection = self.provider.session.collections.get(str(self.path))
-            for _, _, objs in collection.walk():
-                for obj in objs:
-                    self.provoder.session.data_objects.get(
-                        obj.path, str(self.local_path() / obj.path), options=opts
-                    )
+            collection = self.provider.session.collections.get(self._path_str)
         except CollectionDoesNotExist:
             # is file
             self.provider.session.data_objects.get(
-                str(self.path), str(self.local_path()), options=opts
+                self._path_str,
+                str(self.local_path()),
+                num_threads=num_threads,
+                **opts,
             )
+        else:
+            transfers = [
+                (
+                    obj.path,
+                    self.local_path() / PosixPath(obj.path).relative_to(self.path),
+                )
+                for _, _, objs in collection.walk()
+                for obj in objs
+            ]
+            # create all local directories upfront instead of inside the workers
+            for parent in {dst.parent for _, dst in transfers}:
+                os.makedirs(parent, exist_ok=True)
+            with ThreadPoolExecutor(
+                max_workers=self.provider.settings.parallel_transfers
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self.provider.session.data_objects.get,
+                        src,
+                        str(dst),
+                        num_threads=num_threads,
+                        **opts,
+                    )
+                    for src, dst in transfers
+                ]
+                for future in futures:
+                    future.result()
+
+    def _ensure_collection(self, path: PosixPath):
+        known_collections = self.provider._known_collections
+        if str(path) in known_collections:
+            return
+        collections = self.provider.session.collections
+        try:
+            collections.get(str(path))
+        except CAT_NO_ACCESS_PERMISSION:
+            pass
+        except CollectionDoesNotExist:
+            # creates all missing parents as well
+            try:
+                collections.create(str(path), recurse=True)
+            except CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME:
+                # created concurrently by someone else
+                pass
+        # the collection and all its parents exist now (except the root and the zone,
+        # which always exist anyway)
+        known_collections.add(str(path))
+        known_collections.update(str(parent) for parent in path.parents[:-2])
 
     # The following to methods are only required if the class inherits from
     # StorageObjectReadWrite.
@@ -292,33 +587,52 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
     def store_object(self):
         # Ensure that the object is stored at the location specified by
         # self.local_path().
-        def mkdir(path):
-            try:
-                self.provider.session.collections.get(path)
-            except CAT_NO_ACCESS_PERMISSION:
-                pass
-            except CollectionDoesNotExist:
-                self.provider.session.collections.create(path)
-
-        for parent in self.path.parents[:-2][::-1]:
-            mkdir(str(parent))
-
+        opts = {kw.FORCE_FLAG_KW: ""}
+        num_threads = self.provider.settings.parallel_transfer_threads
         if self.local_path().is_dir():
-            mkdir(str(self.path))
-            for f in self.local_path().iterdir():
-                self.provider.session.data_objects.put(str(f), str(self.path / f.name))
+            self._ensure_collection(self.path)
+            files = list(self.local_path().iterdir())
+            with ThreadPoolExecutor(
+                max_workers=self.provider.settings.parallel_transfers
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self.provider.session.data_objects.put,
+                        str(f),
+                        str(self.path / f.name),
+                        num_threads=num_threads,
+                        **opts,
+                    )
+                    for f in files
+                ]
+                for future in futures:
+                    future.result()
         else:
+            if len(self.path.parents) > 2:
+                # skip the root and the zone, which always exist
+                self._ensure_collection(self.path.parent)
             self.provider.session.data_objects.put(
-                str(self.local_path()), str(self.path)
+                str(self.local_path()),
+                self._path_str,
+                num_threads=num_threads,
+                **opts,
             )
+        self._invalidate()
 
     @retry_decorator
     def remove(self):
         # Remove the object from the storage.
         try:
-            self.provider.session.collections.unregister(str(self.path))
+            self.provider.session.collections.unregister(self._path_str)
+            prefix = f"{self._path_str}/"
+            self.provider._known_collections = {
+                path
+                for path in self.provider._known_collections
+                if path != self._path_str and not path.startswith(prefix)
+            }
         except CAT_NAME_EXISTS_AS_DATAOBJ:
-            self.provider.session.data_objects.unregister(str(self.path))
+            self.provider.session.data_objects.unregister(self._path_str)
+        self._invalidate()
 
     # The following to methods are only required if the class inherits from
     # StorageObjectGlob.
@@ -328,12 +642,22 @@ class StorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
         """Return a list of candidate matches in the storage for the query."""
         # This is used by glob_wildcards() to find matches for wildcards in the query.
         # The method has to return concretized queries without any remaining wildcards.
-        # Use snakemake_executor_plugins.io.get_constant_prefix(self.query) to get the
-        # prefix of the query before the first wildcard.
-        ...
-
-    def _convert_time(self, timestamp, tz=None):
-        dt = timestamp.replace(tzinfo=datetime.timezone("UTC"))
-        if tz:
-            dt = dt.astimezone(datetime.timezone(tz))
-        return dt
+        prefix = get_constant_prefix(self.query)
+        matches = self.provider._candidate_matches.get(prefix)
+        if matches is None:
+            irods_prefix = _irods_path(prefix)
+            # list all data objects below the constant directory part of the prefix
+            # in a single query and filter for the complete prefix afterwards
+            parent = irods_prefix.rsplit("/", 1)[0]
+            if not parent:
+                # wildcard within the zone name, never search above the zone
+                parent = f"/{self.provider.settings.zone}"
+            matches = []
+            for row in self.provider.session.query(
+                Collection.name, DataObject.name
+            ).filter(Like(Collection.name, f"{parent}%")):
+                path = f"{row[Collection.name]}/{row[DataObject.name]}"
+                if path.startswith(irods_prefix):
+                    matches.append(f"irods:/{path}")
+            self.provider._candidate_matches[prefix] = matches
+        return matches
@@ -1,9 +1,21 @@
+import asyncio
 from typing import Optional, Type
+from unittest import mock
+
+import pytest
+from snakemake.io import IOCache
+from snakemake_interface_common.exceptions import WorkflowError
 from snakemake_interface_storage_plugins.tests import TestStorageBase
 from snakemake_interface_storage_plugins.storage_provider import StorageProviderBase
 from snakemake_interface_storage_plugins.settings import StorageProviderSettingsBase
+from snakemake_interface_storage_plugins.registry.plugin import Plugin
 
-from snakemake_storage_plugin_irods import StorageProvider, StorageProviderSettings
+import snakemake_storage_plugin_irods
+from snakemake_storage_plugin_irods import (
+    StorageObject,
+    StorageProvider,
+    StorageProviderSettings,
+)
 
 
 class TestStorage(TestStorageBase):
@@ -33,3 +45,159 @@ class TestStorage(TestStorageBase):
             port=1247,
             password="rods",
         )
+
+    def _test_inventory(self, obj):
+        mtime, size = obj.mtime(), obj.size()
+        cache = IOCache(max_wait_time=10)
+        asyncio.run(obj.inventory(cache))
+        # the second run must not perform any action
+        asyncio.run(obj.inventory(cache))
+        key = obj.cache_key()
+        assert cache.exists_in_storage[key]
+        assert cache.mtime[key].storage() == mtime
+        assert cache.size[key] == size
+
+    def test_list_candidate_matches(self, tmp_path):
+        provider = self._get_provider(tmp_path)
+        queries = [
+            "irods://tempZone/test/glob/a.txt",
+            "irods://tempZone/test/glob/b.txt",
+            "irods://tempZone/test/glob/c.txt",
+        ]
+        objs = [provider.object(query) for query in queries]
+        pattern = provider.object("irods://tempZone/test/glob/{name}.txt")
+
+        def store(obj):
+            obj.local_path().parent.mkdir(parents=True, exist_ok=True)
+            obj.local_path().write_text("test")
+            obj.store_object()
+
+        try:
+            for obj in objs[:2]:
+                store(obj)
+            assert sorted(pattern.list_candidate_matches()) == queries[:2]
+            # objects stored later (e.g. by a checkpoint) have to show up as well
+            store(objs[2])
+            assert sorted(pattern.list_candidate_matches()) == queries
+        finally:
+            for obj in objs:
+                if obj.exists():
+                    obj.remove()
+
+
+@pytest.mark.parametrize(
+    "query,valid",
+    [
+        ("irods://tempZone/test/test.txt", True),
+        ("irods://tempZone/{sample}.txt", True),
+        ("IRODS://tempZone/a", True),
+        ("irods://tempZone", False),
+        ("irods://tempZone/", False),
+        ("irods://tempZone/?x", False),
+        ("irods://tempZone/#x", False),
+        ("irods://tempZone?x/y", False),
+        ("irods://tempZone#/y", False),
+        ("s3://tempZone/a", False),
+    ],
+)
+def test_is_valid_query(query, valid):
+    assert StorageProvider.is_valid_query(query).valid == valid
+
+
+def test_invalid_parallel_transfers():
+    with pytest.raises(WorkflowError):
+        StorageProviderSettings(parallel_transfers=0)
+
+
+@pytest.mark.parametrize("interval", [-1, 0.5])
+def test_invalid_keepalive_interval(interval):
+    with pytest.raises(WorkflowError):
+        StorageProviderSettings(keepalive_interval=interval)
+
+
+def test_validate_settings_without_password(tmp_path, monkeypatch):
+    # the password may be taken from ~/.irods/.irodsA by the provider
+    monkeypatch.setenv("HOME", str(tmp_path))
+    plugin = Plugin(
+        storage_provider=StorageProvider,
+        storage_object=StorageObject,
+        _storage_settings_cls=StorageProviderSettings,
+        _name="irods",
+    )
+    plugin.validate_settings(
+        StorageProviderSettings(
+            username="rods",
+            zone="tempZone",
+            host="localhost",
+            port=1247,
+            home="/tempZone/home/rods",
+        )
+    )
+
+
+def test_provider_without_password(tmp_path, monkeypatch):
+    # neither a password setting nor ~/.irods/.irodsA
+    monkeypatch.setenv("HOME", str(tmp_path))
+    with pytest.raises(WorkflowError):
+        StorageProvider(
+            local_prefix=tmp_path / "local_prefix",
+            settings=StorageProviderSettings(
+                username="rods",
+                zone="tempZone",
+                host="localhost",
+                port=1247,
+            ),
+        )
+
+
+@pytest.fixture
+def mocked_provider(tmp_path, monkeypatch):
+    # provider with a mocked iRODS session, for tests without a server
+    monkeypatch.setattr(snakemake_storage_plugin_irods, "iRODSSession", mock.MagicMock)
+    # do not pick up sessions pooled by other tests
+    monkeypatch.setattr(snakemake_storage_plugin_irods, "_SESSION_POOL", {})
+    monkeypatch.setattr(snakemake_storage_plugin_irods, "_SESSION_USERS", {})
+    provider = StorageProvider(
+        local_prefix=tmp_path / "local_prefix",
+        settings=StorageProviderSettings(
+            username="rods",
+            zone="tempZone",
+            host="localhost",
+            port=1247,
+            password="rods",
+            keepalive_interval=0,
+        ),
+    )
+    yield provider
+    provider.close()
+
+
+def test_overwritten_local_path(tmp_path, mocked_provider):
+    # e.g. used by Snakemake for uploading sources, such objects have no cache key
+    provider = mocked_provider
+    cache = IOCache(max_wait_time=10)
+    asyncio.run(provider.object("irods://tempZone/test/a.txt").inventory(cache))
+
+    obj = provider.object("irods://tempZone/test/source.txt")
+    obj.set_local_path(tmp_path / "source.txt")
+    obj.local_path().write_text("test")
+    asyncio.run(obj.inventory(cache))
+    assert obj.exists()
+    obj.store_object()
+    provider.session.data_objects.put.assert_called_once()
+
+
+def test_data_object_reuse(mocked_provider):
+    data_objects = mocked_provider.session.data_objects
+    cache = IOCache(max_wait_time=10)
+    obj = mocked_provider.object("irods://tempZone/test/a.txt")
+    asyncio.run(obj.inventory(cache))
+    obj.exists()
+    obj.size()
+    assert data_objects.get.call_count == 1
+
+    # afterwards, Snakemake expects up to date information
+    cache.deactivate()
+    obj.exists()
+    obj.size()
+    assert data_objects.get.call_count == 3